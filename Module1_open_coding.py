@@ -1,65 +1,140 @@
 import re
 import json
 import time
-from typing import List, Dict, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, List, Dict, Optional, Tuple, Union
 
-import requests
 import pandas as pd
+import requests
 
+import llm_cache
+from checkpoint import ResumableBatch
+from utils import SESSION, safe_parse_json, dumps_json_bytes, loads_json, post_chat_content, call_with_backoff
 
-def parse_qa_blocks(text: str) -> List[Dict[str, str]]:
-    blocks = []
-    current_q = None
-    current_a_lines: List[str] = []
 
-    for raw_line in text.splitlines():
-        line = raw_line.strip()
-        if not line:
-            continue
+_RE_QA_ANCHOR = re.compile(r"^[^\S\n]*([QA])[:：][^\S\n]*(.*)$", re.MULTILINE)
+# 只匹配已闭合的 JSON 字符串（允许其中出现 \" 等转义），避免流式读取时在转义引号处截断
+_RE_OPEN_CODE = re.compile(r'"open_code"\s*:\s*"((?:[^"\\]|\\.)+)"')
+
+
+def _search_open_code(text: str) -> Optional[str]:
+    m = _RE_OPEN_CODE.search(text)
+    if not m:
+        return None
+    try:
+        return json.loads('"' + m.group(1) + '"')
+    except ValueError:
+        return m.group(1)  # 非法转义：退回原始片段
+
 
-        if line.startswith(("Q:", "Q：")):
-            if current_q is not None and current_a_lines:
-                blocks.append({"question": current_q.strip(), "answer": "\n".join(current_a_lines).strip()})
-                current_a_lines = []
-            current_q = re.sub(r"^Q[:：]\s*", "", line)
+# 占位结果的前缀：均不写入断点，续跑时会重新编码
+FAILED_PREFIX = "[API 调用多次失败"
+UNPARSED_PREFIX = "[未解析出 open_code，需人工检查] "  # 后接模型原始回复
 
-        elif line.startswith(("A:", "A：")):
-            a_body = re.sub(r"^A[:：]\s*", "", line)
-            if a_body:
-                current_a_lines.append(a_body)
 
-        else:
+def is_placeholder_code(code: str) -> bool:
+    return code.startswith(FAILED_PREFIX) or code.startswith(UNPARSED_PREFIX)
+
+
+def iter_qa_blocks(chunks: Iterable[str]) -> Iterator[Dict[str, str]]:
+    """
+    从文本分块（如逐块读取的文件）中流式切出 QA 片段：只解析到最后一个完整行，
+    不完整的行留到下一块拼接；每遇到新的 Q 即产出上一段 QA。
+    """
+    current_q = None
+    current_a_lines: List[str] = []
+
+    def feed_plain_lines(segment: str):
+        # 两个 Q/A 锚点之间的普通行：续接到当前回答，或（尚无回答时）续接到问题
+        nonlocal current_q
+        for raw_line in segment.splitlines():
+            line = raw_line.strip()
+            if not line:
+                continue
             if current_a_lines:
                 current_a_lines.append(line)
             elif current_q is not None:
                 current_q += " " + line
 
-    if current_q is not None and current_a_lines:
-        blocks.append({"question": current_q.strip(), "answer": "\n".join(current_a_lines).strip()})
+    def parse_segment(segment: str) -> Iterator[Dict[str, str]]:
+        # 一次 finditer 定位段内所有 Q:/A: 行，锚点之间的文本整段切片处理
+        nonlocal current_q
+        prev_end = 0
+        for m in _RE_QA_ANCHOR.finditer(segment):
+            feed_plain_lines(segment[prev_end:m.start()])
+            prev_end = m.end()
+            body = m.group(2).strip()
 
-    return blocks
+            if m.group(1) == "Q":
+                if current_q is not None and current_a_lines:
+                    yield {"question": current_q.strip(), "answer": "\n".join(current_a_lines).strip()}
+                    current_a_lines.clear()
+                current_q = body
+            elif body:
+                current_a_lines.append(body)
 
+        feed_plain_lines(segment[prev_end:])
 
-def safe_parse_json(text: str) -> Optional[dict]:
-    if not isinstance(text, str):
-        return None
-    s = text.strip()
-    s = re.sub(r"^```json\s*", "", s, flags=re.IGNORECASE)
-    s = re.sub(r"^```\s*", "", s)
-    s = re.sub(r"\s*```$", "", s)
+    tail = ""
+    for chunk in chunks:
+        buf = tail + chunk
+        cut = buf.rfind("\n") + 1
+        tail = buf[cut:]
+        if cut:
+            yield from parse_segment(buf[:cut])
+    yield from parse_segment(tail)
+
+    if current_q is not None and current_a_lines:
+        yield {"question": current_q.strip(), "answer": "\n".join(current_a_lines).strip()}
 
-    try:
-        return json.loads(s)
-    except Exception:
-        pass
 
-    if "{" in s and "}" in s:
-        snippet = s[s.find("{"): s.rfind("}") + 1]
+def parse_qa_blocks(text: str) -> List[Dict[str, str]]:
+    return list(iter_qa_blocks([text]))
+
+
+@llm_cache.cached(accept=lambda content: _RE_OPEN_CODE.search(content) is not None)
+def _post_open_code_stream(
+    *,
+    session: requests.Session,
+    base_url: str,
+    headers: Dict[str, str],
+    body: bytes,
+    timeout: int,
+    limiter: Optional[threading.Semaphore] = None,
+) -> str:
+    """
+    以 SSE 流式读取回复，一旦累计文本中 "open_code" 的字符串值已闭合就提前断开，
+    不再等待模型输出后续的多余内容。
+    """
+    def send() -> str:
+        resp = session.post(base_url, headers=headers, data=body, timeout=timeout, stream=True)
         try:
-            return json.loads(snippet)
-        except Exception:
-            return None
-    return None
+            resp.raise_for_status()
+            if "text/event-stream" not in resp.headers.get("Content-Type", ""):
+                return loads_json(resp.content)["choices"][0]["message"]["content"].strip()
+
+            parts: List[str] = []
+            for line in resp.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                choices = loads_json(data).get("choices") or []
+                if not choices:
+                    continue
+                piece = (choices[0].get("delta") or {}).get("content") or ""
+                if not piece:
+                    continue
+                parts.append(piece)
+                if '"' in piece and _RE_OPEN_CODE.search("".join(parts)):
+                    break
+            return "".join(parts).strip()
+        finally:
+            resp.close()
+
+    return call_with_backoff(send, limiter=limiter)
 
 
 def open_code_answer(
@@ -73,8 +148,11 @@ def open_code_answer(
     max_retries: int = 3,
     retry_sleep: float = 2.0,
     timeout: int = 120,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
+    stream: bool = True,
 ) -> str:
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+    headers = {"Authorization": f"Bearer {api_key}"}
 
     user_content = (
         "下面是一段访谈问答片段。\n"
@@ -92,54 +170,268 @@ def open_code_answer(
         "temperature": 0,
         "stream": False,
     }
+    body = dumps_json_bytes(payload)
+    stream_body = dumps_json_bytes({**payload, "stream": True})
 
+    use_stream = stream
     last_err = None
     for attempt in range(1, max_retries + 1):
         try:
-            resp = requests.post(base_url, headers=headers, json=payload, timeout=timeout)
-            resp.raise_for_status()
-            raw_text = resp.json()["choices"][0]["message"]["content"].strip()
+            if use_stream:
+                try:
+                    raw_text = _post_open_code_stream(
+                        session=session,
+                        base_url=base_url,
+                        headers=headers,
+                        body=stream_body,
+                        timeout=timeout,
+                        limiter=limiter,
+                    )
+                except (ValueError, KeyError, IndexError, TypeError):
+                    use_stream = False  # SSE 解析失败：之后改走整包响应
+                    raise
+            else:
+                raw_text = post_chat_content(
+                    session=session, base_url=base_url, headers=headers, body=body, timeout=timeout, limiter=limiter
+                ).strip()
 
             obj = safe_parse_json(raw_text)
             if isinstance(obj, dict) and "open_code" in obj:
                 return str(obj["open_code"]).strip()
 
-            m = re.search(r'"open_code"\s*:\s*"([^"]+)"', raw_text)
-            if m:
-                return m.group(1).strip()
+            code = _search_open_code(raw_text)
+            if code is not None:
+                return code.strip()
 
-            return raw_text
+            llm_cache.invalidate(stream_body if use_stream else body)
+            return UNPARSED_PREFIX + raw_text
 
         except Exception as e:
             last_err = e
             if attempt < max_retries:
                 time.sleep(retry_sleep)
 
-    return f"[API 调用多次失败: {repr(last_err)}]"
+    return f"{FAILED_PREFIX}: {repr(last_err)}]"
 
 
-def run_open_coding_from_text(
+def _normalize_open_codes_result(data: Dict[str, Any], batch_size: int) -> Dict[int, str]:
+    if not data or "open_codes" not in data or not isinstance(data["open_codes"], list):
+        return {}
+
+    out: Dict[int, str] = {}
+    for item in data["open_codes"]:
+        try:
+            bid = int(item.get("id"))
+        except Exception:
+            continue
+        if bid < 1 or bid > batch_size or bid in out:
+            continue
+        code = str(item.get("open_code", "")).strip()
+        if code:
+            out[bid] = code
+    return out
+
+
+def open_code_batch(
     *,
-    text: str,
+    blocks: List[Dict[str, str]],
     base_url: str,
     api_key: str,
     model: str,
     system_prompt: str,
-    sleep_time: float = 1.0,
-) -> pd.DataFrame:
-    qa_blocks = parse_qa_blocks(text)
-    rows = []
+    batch_system_prompt: Optional[str] = None,
+    max_retries: int = 2,
+    retry_sleep: float = 2.0,
+    timeout: int = 180,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
+) -> List[str]:
+    """
+    一次请求对多个 QA 片段做开放编码，返回与 blocks 同序的 open_code 列表。
+    batch_system_prompt 为批量请求所用的系统提示（须要求按 id 输出 open_codes，缺省时沿用 system_prompt）；
+    模型漏返回 / 解析失败的条目，回退为用 system_prompt 的单条 open_code_answer 重新编码。
+    """
+    n = len(blocks)
+    if n == 0:
+        return []
+    if n == 1:
+        return [
+            open_code_answer(
+                question=blocks[0]["question"],
+                answer=blocks[0]["answer"],
+                base_url=base_url,
+                api_key=api_key,
+                model=model,
+                system_prompt=system_prompt,
+                session=session,
+                limiter=limiter,
+            )
+        ]
 
-    for idx, block in enumerate(qa_blocks, start=1):
-        code = open_code_answer(
-            question=block["question"],
-            answer=block["answer"],
+    headers = {"Authorization": f"Bearer {api_key}"}
+
+    payload_blocks = {
+        "qa_blocks": [
+            {"id": i + 1, "question": b["question"], "answer": b["answer"]} for i, b in enumerate(blocks)
+        ]
+    }
+    blocks_json_str = json.dumps(payload_blocks, ensure_ascii=False, separators=(",", ":"))
+
+    user_content = (
+        "下面是一组访谈问答片段（JSON）：\n"
+        f"{blocks_json_str}\n\n"
+        "请对每个片段分别进行开放性编码：仅基于 answer 的内容编码，question 只用来帮助你理解语境，不要对问题本身编码。\n"
+        '只输出 JSON：{"open_codes":[{"id":1,"open_code":"编码结果"}]}，id 必须与输入一一对应。'
+    )
+
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": batch_system_prompt or system_prompt},
+            {"role": "user", "content": user_content},
+        ],
+        "temperature": 0,
+        "stream": False,
+    }
+    body = dumps_json_bytes(payload)
+
+    id2code: Dict[int, str] = {}
+    for attempt in range(1, max_retries + 1):
+        try:
+            raw_text = post_chat_content(
+                session=session, base_url=base_url, headers=headers, body=body, timeout=timeout, limiter=limiter
+            )
+            id2code = _normalize_open_codes_result(safe_parse_json(raw_text) or {}, n)
+            if id2code:
+                break
+            llm_cache.invalidate(body)
+        except Exception:
+            pass
+        if attempt < max_retries:
+            time.sleep(retry_sleep)
+
+    codes = []
+    for bid, block in enumerate(blocks, start=1):
+        if bid in id2code:
+            codes.append(id2code[bid])
+            continue
+        codes.append(
+            open_code_answer(
+                question=block["question"],
+                answer=block["answer"],
+                base_url=base_url,
+                api_key=api_key,
+                model=model,
+                system_prompt=system_prompt,
+                session=session,
+                limiter=limiter,
+            )
+        )
+    return codes
+
+
+def iter_open_coding_from_text(
+    *,
+    text: Union[str, Iterable[str]],
+    base_url: str,
+    api_key: str,
+    model: str,
+    system_prompt: str,
+    batch_system_prompt: Optional[str] = None,
+    batch_size: int = 20,
+    concurrency: int = 16,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
+    checkpoint: Optional[ResumableBatch] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    逐行产出开放编码结果（按 qa_blocks 顺序），某一批完成后即可被下游消费，
+    不必等待全部 QA 编码结束。text 可以是完整字符串，也可以是逐块读取的文本迭代器。
+    """
+    chunks = [text] if isinstance(text, str) else text
+    qa_blocks: List[Dict[str, str]] = []
+    keys: List[str] = []
+    step = max(1, batch_size)
+
+    def iter_batches() -> Iterator[List[int]]:
+        # 边读边切批：每凑满一批待编码的 QA 就交给线程池，不必等整份文本解析完
+        batch: List[int] = []
+        for block in iter_qa_blocks(chunks):
+            i = len(qa_blocks)
+            qa_blocks.append(block)
+            keys.append(ResumableBatch.key(model, system_prompt, block["question"], block["answer"]))
+            # 断点续跑：已落盘的 QA 直接复用，只对剩余部分分批请求
+            if checkpoint is not None and keys[i] in checkpoint:
+                continue
+            batch.append(i)
+            if len(batch) >= step:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def code_batch(idxs: List[int]) -> Tuple[List[int], List[str]]:
+        codes = open_code_batch(
+            blocks=[qa_blocks[i] for i in idxs],
             base_url=base_url,
             api_key=api_key,
             model=model,
             system_prompt=system_prompt,
+            batch_system_prompt=batch_system_prompt,
+            session=session,
+            limiter=limiter,
         )
-        rows.append({"id": idx, "question": block["question"], "answer": block["answer"], "open_code": code})
-        time.sleep(sleep_time)
+        if checkpoint is not None:
+            checkpoint.record_many(
+                (keys[i], code) for i, code in zip(idxs, codes) if not is_placeholder_code(code)
+            )
+        return idxs, codes
+
+    def make_row(i: int, code: str) -> Dict[str, Any]:
+        block = qa_blocks[i]
+        return {"id": i + 1, "question": block["question"], "answer": block["answer"], "open_code": code}
 
-    return pd.DataFrame(rows)
+    # 网络 IO 为主：线程池并发请求，executor.map 保证结果与 qa_blocks 同序
+    nxt = 0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for idxs, codes in pool.map(code_batch, iter_batches()):
+            for i, code in zip(idxs, codes):
+                # 先补齐排在它前面、已从 checkpoint 恢复的 QA
+                while nxt < i:
+                    yield make_row(nxt, checkpoint.get(keys[nxt]))
+                    nxt += 1
+                yield make_row(i, code)
+                nxt = i + 1
+    while nxt < len(qa_blocks):
+        yield make_row(nxt, checkpoint.get(keys[nxt]))
+        nxt += 1
+
+
+def run_open_coding_from_text(
+    *,
+    text: Union[str, Iterable[str]],
+    base_url: str,
+    api_key: str,
+    model: str,
+    system_prompt: str,
+    batch_system_prompt: Optional[str] = None,
+    batch_size: int = 20,
+    concurrency: int = 16,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
+    checkpoint: Optional[ResumableBatch] = None,
+) -> pd.DataFrame:
+    rows = iter_open_coding_from_text(
+        text=text,
+        base_url=base_url,
+        api_key=api_key,
+        model=model,
+        system_prompt=system_prompt,
+        batch_system_prompt=batch_system_prompt,
+        session=session,
+        limiter=limiter,
+        batch_size=batch_size,
+        concurrency=concurrency,
+        checkpoint=checkpoint,
+    )
+    return pd.DataFrame(list(rows))
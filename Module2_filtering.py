@@ -1,45 +1,21 @@
-import re
 import json
 import time
-from typing import Any, Dict, List, Tuple, Optional
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import pandas as pd
 import requests
 
+import llm_cache
+from checkpoint import ResumableBatch
+from utils import SESSION, safe_parse_json, dumps_json_bytes, post_chat_content, is_non_retriable_http_error
 
-def safe_parse_json(text: str) -> Optional[dict]:
-    if not isinstance(text, str):
-        return None
-    s = text.strip()
-    s = re.sub(r"^```json\s*", "", s, flags=re.IGNORECASE)
-    s = re.sub(r"^```\s*", "", s)
-    s = re.sub(r"\s*```$", "", s)
+MISSING_REASON = "模型未返回该条结果，需人工检查"  # 模型漏答时的占位原因
 
-    try:
-        return json.loads(s)
-    except Exception:
-        pass
-
-    if "{" in s and "}" in s:
-        snippet = s[s.find("{"): s.rfind("}") + 1]
-        try:
-            return json.loads(snippet)
-        except Exception:
-            return None
-    return None
-
-
-def _call_filter_batch(
-    *,
-    batch_items: List[Dict[str, Any]],
-    base_url: str,
-    api_key: str,
-    model: str,
-    system_prompt: str,
-    timeout: int = 180,
-) -> Dict[str, Any]:
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
 
+def _build_filter_body(*, batch_items: List[Dict[str, Any]], model: str, system_prompt: str) -> bytes:
     payload_codes = {"open_codes": batch_items}
     codes_json_str = json.dumps(payload_codes, ensure_ascii=False, separators=(",", ":"))
 
@@ -58,10 +34,23 @@ def _call_filter_batch(
         "temperature": 0,
         "stream": False,
     }
+    return dumps_json_bytes(payload)
+
 
-    resp = requests.post(base_url, headers=headers, json=payload, timeout=timeout)
-    resp.raise_for_status()
-    raw_text = resp.json()["choices"][0]["message"]["content"]
+def _call_filter_batch(
+    *,
+    body: bytes,
+    base_url: str,
+    api_key: str,
+    timeout: int = 180,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
+) -> Dict[str, Any]:
+    headers = {"Authorization": f"Bearer {api_key}"}
+
+    raw_text = post_chat_content(
+        session=session, base_url=base_url, headers=headers, body=body, timeout=timeout, limiter=limiter
+    )
     return safe_parse_json(raw_text) or {}
 
 
@@ -69,144 +58,264 @@ def _normalize_filtering_result(data: Dict[str, Any], batch_size: int) -> List[D
     if not data or "filtering" not in data or not isinstance(data["filtering"], list):
         return []
 
-    seen = set()
-    out = []
+    # bytearray 作 id 出现标记，out 按 id 预分配位置，结果天然有序
+    present = bytearray(batch_size + 1)
+    out: List[Dict[str, Any]] = [None] * batch_size
     for item in data["filtering"]:
         try:
             bid = int(item.get("id"))
         except Exception:
             continue
-        if bid < 1 or bid > batch_size or bid in seen:
+        if bid < 1 or bid > batch_size or present[bid]:
             continue
-        seen.add(bid)
+        present[bid] = 1
 
         retain = bool(item.get("retain"))
         reason = str(item.get("exclude_reason", "")).strip()
         if retain:
             reason = ""
-        out.append({"id": bid, "retain": retain, "exclude_reason": reason})
+        out[bid - 1] = {"id": bid, "retain": retain, "exclude_reason": reason}
 
     for bid in range(1, batch_size + 1):
-        if bid not in seen:
-            out.append({"id": bid, "retain": False, "exclude_reason": "模型未返回该条结果，需人工检查"})
+        if not present[bid]:
+            out[bid - 1] = {"id": bid, "retain": False, "exclude_reason": MISSING_REASON}
 
-    out.sort(key=lambda x: x["id"])
     return out
 
 
-def filter_unique_codes_with_batching(
+_END = object()  # 上游 codes 迭代结束的队列哨兵
+
+
+def filter_codes_streaming(
     *,
-    unique_codes: List[str],
+    codes: Iterable[str],
     base_url: str,
     api_key: str,
     model: str,
     system_prompt: str,
     batch_size: int = 60,
-    between_batch_sleep: float = 1.0,
+    max_wait_ms: Optional[float] = None,
+    max_workers: int = 4,
     max_retries_each_batch: int = 2,
     retry_sleep: float = 2.0,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
+    checkpoint: Optional[ResumableBatch] = None,
 ) -> Tuple[Dict[int, bool], Dict[int, str], Dict[int, str]]:
-    id2code = {i + 1: code for i, code in enumerate(unique_codes)}
+    """
+    边接收 open_code 边筛选：codes 可以是上游（Module1）仍在产出的迭代器。
+    按首次出现顺序保序去重并分配 code_id，动态组批：凑满 batch_size 条待筛选的新 code，
+    或距本批第一条到达已过 max_wait_ms（None 表示不按时间提交）即提交一批，
+    无需等待上游全部结束。传入 checkpoint 时，已记录结果的 code 直接复用、不再请求。
+    """
+    unique_codes: List[str] = []
     id2retain: Dict[int, bool] = {}
     id2reason: Dict[int, str] = {}
+    lock = threading.Lock()
+
+    def code_key(code: str) -> str:
+        return ResumableBatch.key(model, system_prompt, code)
 
-    def process_range(start_idx: int, end_idx: int):
-        sub = unique_codes[start_idx:end_idx]
-        global_ids = list(range(start_idx + 1, end_idx + 1))
-        n = len(sub)
+    def process_ids(gids: List[int], depth: int = 0):
+        n = len(gids)
         if n == 0:
             return
 
-        batch_items = [{"id": i + 1, "text": sub[i]} for i in range(n)]
+        batch_items = [{"id": i + 1, "text": unique_codes[gid - 1]} for i, gid in enumerate(gids)]
+        body = _build_filter_body(batch_items=batch_items, model=model, system_prompt=system_prompt)
 
         last_err = None
         for attempt in range(1, max_retries_each_batch + 1):
             try:
                 data = _call_filter_batch(
-                    batch_items=batch_items,
-                    base_url=base_url,
-                    api_key=api_key,
-                    model=model,
-                    system_prompt=system_prompt,
+                    body=body, base_url=base_url, api_key=api_key, session=session, limiter=limiter
                 )
                 filtering = _normalize_filtering_result(data, n)
                 if not filtering:
+                    llm_cache.invalidate(body)
                     raise ValueError("解析失败/无 filtering")
 
-                for item in filtering:
-                    bid = int(item["id"])
-                    gid = global_ids[bid - 1]
-                    id2retain[gid] = bool(item["retain"])
-                    id2reason[gid] = str(item["exclude_reason"]).strip()
+                done = []
+                with lock:
+                    for item in filtering:
+                        gid = gids[int(item["id"]) - 1]
+                        retain = bool(item["retain"])
+                        reason = str(item["exclude_reason"]).strip()
+                        id2retain[gid] = retain
+                        id2reason[gid] = reason
+                        if not retain and reason == MISSING_REASON:
+                            continue  # 漏答的占位结果不写入断点，续跑时重新筛选
+                        done.append((code_key(unique_codes[gid - 1]), {"retain": retain, "exclude_reason": reason}))
+                if checkpoint is not None:
+                    checkpoint.record_many(done)
                 return
             except Exception as e:
                 last_err = e
+                if is_non_retriable_http_error(e):
+                    break
                 if attempt < max_retries_each_batch:
                     time.sleep(retry_sleep)
 
         if n == 1:
-            gid = global_ids[0]
-            id2retain[gid] = False
-            id2reason[gid] = f"API失败/解析失败（单条）：{repr(last_err)}"
+            gid = gids[0]
+            with lock:
+                id2retain[gid] = False
+                id2reason[gid] = f"API失败/解析失败（单条）：{repr(last_err)}"
+            return
+
+        # 已连续二分两次仍失败且剩余很少：直接逐条处理，不再继续二分
+        if depth >= 2 and n <= 8:
+            for gid in gids:
+                process_ids([gid], depth + 1)
             return
 
-        mid = start_idx + n // 2
-        process_range(start_idx, mid)
-        process_range(mid, end_idx)
+        mid = n // 2
+        process_ids(gids[:mid], depth + 1)
+        process_ids(gids[mid:], depth + 1)
 
-    total = len(unique_codes)
-    for s in range(0, total, batch_size):
-        e = min(s + batch_size, total)
-        process_range(s, e)
-        time.sleep(between_batch_sleep)
+    # 上游迭代放到单独线程里喂入队列，主线程才能在等待新 code 时按 max_wait_ms 超时提交残批
+    q: "queue.Queue[Any]" = queue.Queue()
+    feed_err: List[Exception] = []
 
+    def feed():
+        try:
+            for code in codes:
+                q.put(code)
+        except Exception as e:
+            feed_err.append(e)
+        finally:
+            q.put(_END)
+
+    wait_s = None if max_wait_ms is None else max(0.0, max_wait_ms) / 1000.0
+    seen = set()
+    futures = []
+    pending: List[int] = []
+    deadline: Optional[float] = None
+
+    # 各批次相互独立：线程池并发提交，max_workers 即同时在途的请求上限
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+
+        def flush():
+            nonlocal pending, deadline
+            if pending:
+                futures.append(pool.submit(process_ids, pending))
+            pending = []
+            deadline = None
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                code = q.get(timeout=timeout)
+            except queue.Empty:
+                flush()
+                continue
+            if code is _END:
+                break
+            if code in seen:
+                continue
+            seen.add(code)
+            unique_codes.append(code)
+            gid = len(unique_codes)
+
+            key = code_key(code) if checkpoint is not None else None
+            if key is not None and key in checkpoint:
+                rec = checkpoint.get(key)
+                id2retain[gid] = bool(rec["retain"])
+                id2reason[gid] = str(rec["exclude_reason"])
+                continue
+
+            pending.append(gid)
+            if wait_s is not None and deadline is None:
+                deadline = time.monotonic() + wait_s
+            if len(pending) >= batch_size:
+                flush()
+        flush()
+        feeder.join()
+
+        for fut in as_completed(futures):
+            fut.result()
+
+    if feed_err:
+        raise feed_err[0]
+
+    id2code = {i + 1: code for i, code in enumerate(unique_codes)}
     return id2retain, id2reason, id2code
 
 
+def filter_unique_codes_with_batching(
+    *,
+    unique_codes: List[str],
+    base_url: str,
+    api_key: str,
+    model: str,
+    system_prompt: str,
+    batch_size: int = 60,
+    max_wait_ms: Optional[float] = None,
+    max_workers: int = 4,
+    max_retries_each_batch: int = 2,
+    retry_sleep: float = 2.0,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
+    checkpoint: Optional[ResumableBatch] = None,
+) -> Tuple[Dict[int, bool], Dict[int, str], Dict[int, str]]:
+    return filter_codes_streaming(
+        codes=unique_codes,
+        base_url=base_url,
+        api_key=api_key,
+        model=model,
+        system_prompt=system_prompt,
+        batch_size=batch_size,
+        max_wait_ms=max_wait_ms,
+        max_workers=max_workers,
+        max_retries_each_batch=max_retries_each_batch,
+        retry_sleep=retry_sleep,
+        session=session,
+        limiter=limiter,
+        checkpoint=checkpoint,
+    )
+
+
 def build_filter_outputs_from_open_df(
     *,
     open_df: pd.DataFrame,
     id2retain: Dict[int, bool],
     id2reason: Dict[int, str],
     id2code: Dict[int, str],
-) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    emit_excluded: bool = True,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, Optional[pd.DataFrame]]:
+    """
+    返回 (row_df, unique_df, retain_unique_df, exclude_unique_df)。
+    exclude_unique_df 仅供人工审计、下游不读取；emit_excluded=False 时不构造，返回 None。
+    """
+    cids = list(id2code.keys())
+    # dtype 在构造时一次定好（code_id 为 int32，open_code 已在上游 strip），下游无需再 astype
     unique_df = pd.DataFrame(
-        [
-            {
-                "code_id": cid,
-                "open_code": txt,
-                "retain": bool(id2retain.get(cid, False)),
-                "exclude_reason": str(id2reason.get(cid, "未返回该条结果")).strip(),
-            }
-            for cid, txt in id2code.items()
-        ]
+        {
+            "code_id": pd.Series(cids, dtype="int32"),
+            "open_code": list(id2code.values()),
+            "retain": [bool(id2retain.get(cid, False)) for cid in cids],
+            "exclude_reason": [str(id2reason.get(cid, "未返回该条结果")).strip() for cid in cids],
+        }
     )
 
-    retain_unique_df = unique_df[unique_df["retain"] == True].copy()
-    exclude_unique_df = unique_df[unique_df["retain"] == False].copy()
-
-    code2id = {v: k for k, v in id2code.items()}
-
-    def map_code_id(x):
-        if not isinstance(x, str):
-            return ""
-        return code2id.get(x.strip(), "")
-
-    def map_retain(x):
-        if not isinstance(x, str):
-            return False
-        cid = code2id.get(x.strip(), None)
-        return bool(id2retain.get(cid, False)) if cid else False
+    mask = unique_df["retain"].to_numpy(dtype=bool)
+    retain_unique_df = unique_df[mask]
+    exclude_unique_df = unique_df[~mask] if emit_excluded else None
 
-    def map_reason(x):
-        if not isinstance(x, str):
-            return ""
-        cid = code2id.get(x.strip(), None)
-        return id2reason.get(cid, "open_code 未在 unique 集合中") if cid else "open_code 未在 unique 集合中"
+    # 直接复用 unique_df 的两列作查找表，不再额外构造反向 dict
+    code2id = pd.Series(unique_df["code_id"].to_numpy(dtype=object), index=unique_df["open_code"].to_numpy())
 
     row_df = open_df.copy()
-    row_df["code_id"] = row_df["open_code"].apply(map_code_id)
-    row_df["retain"] = row_df["open_code"].apply(map_retain)
-    row_df["exclude_reason"] = row_df["open_code"].apply(map_reason)
+    # 非字符串的 open_code 经 .str.strip() 后为 NaN，只判断一次
+    stripped = row_df["open_code"].astype(object).str.strip()
+    is_str = stripped.notna()
+    cid = stripped.map(code2id)
+
+    # 与 unique_df 同为 32 位整数，未匹配的行为 <NA>（写出 xlsx 时同样是空单元格）；下游按 code_id map 时无需再转换类型
+    row_df["code_id"] = cid.astype("Int32")
+    row_df["retain"] = cid.map(id2retain).eq(True)  # 未筛到的 id 为 NaN，按不保留处理；避免 fillna 在 object 列上的降级告警
+    row_df["exclude_reason"] = cid.map(id2reason).fillna("open_code 未在 unique 集合中").where(is_str, "")
 
     return row_df, unique_df, retain_unique_df, exclude_unique_df
@@ -1,32 +1,13 @@
-import re
 import json
 import time
+import threading
 from typing import Dict, Optional
 
 import pandas as pd
 import requests
 
-
-def safe_parse_json(text: str) -> Optional[dict]:
-    if not isinstance(text, str):
-        return None
-    s = text.strip()
-    s = re.sub(r"^```json\s*", "", s, flags=re.IGNORECASE)
-    s = re.sub(r"^```\s*", "", s)
-    s = re.sub(r"\s*```$", "", s)
-
-    try:
-        return json.loads(s)
-    except Exception:
-        pass
-
-    if "{" in s and "}" in s:
-        snippet = s[s.find("{"): s.rfind("}") + 1]
-        try:
-            return json.loads(snippet)
-        except Exception:
-            return None
-    return None
+import llm_cache
+from utils import SESSION, EndpointPool, safe_parse_json, dumps_json_bytes, post_chat_content
 
 
 def deepseek_axial_coding(
@@ -40,10 +21,20 @@ def deepseek_axial_coding(
     retry_sleep: float = 3.0,
     sleep_time: float = 1.0,
     timeout: int = 240,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
+    endpoints: Optional[EndpointPool] = None,
 ) -> Dict[int, str]:
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
-
-    id2code = {int(r["code_id"]): str(r["open_code"]).strip() for _, r in retain_unique_df.iterrows()}
+    """
+    传入 endpoints 时请求经由端点池发出（按空闲名额选端点、失败自动换端点），
+    此时 base_url / session / limiter 不再使用。
+    """
+    headers = {"Authorization": f"Bearer {api_key}"}
+
+    id2code = {
+        int(c): str(t).strip()
+        for c, t in zip(retain_unique_df["code_id"].to_numpy(), retain_unique_df["open_code"].to_numpy())
+    }
     payload_codes = {"open_codes": [{"id": cid, "text": txt} for cid, txt in id2code.items()]}
     codes_json_str = json.dumps(payload_codes, ensure_ascii=False, separators=(",", ":"))
 
@@ -62,13 +53,17 @@ def deepseek_axial_coding(
         "temperature": 0,
         "stream": False,
     }
+    body = dumps_json_bytes(payload)
 
     last_err = None
     for attempt in range(1, max_retries + 1):
         try:
-            resp = requests.post(base_url, headers=headers, json=payload, timeout=timeout)
-            resp.raise_for_status()
-            raw_text = resp.json()["choices"][0]["message"]["content"]
+            if endpoints is not None:
+                raw_text = endpoints.post_chat_content(headers=headers, body=body, timeout=timeout)
+            else:
+                raw_text = post_chat_content(
+                    session=session, base_url=base_url, headers=headers, body=body, timeout=timeout, limiter=limiter
+                )
             data = safe_parse_json(raw_text)
 
             if data and "axial_coding" in data and isinstance(data["axial_coding"], list):
@@ -83,6 +78,7 @@ def deepseek_axial_coding(
                         id2axial[cid] = axial
                 time.sleep(sleep_time)
                 return id2axial
+            llm_cache.invalidate(body)
         except Exception as e:
             last_err = e
             if attempt < max_retries:
@@ -92,40 +88,35 @@ def deepseek_axial_coding(
 
 
 def attach_axial_to_retain_unique(retain_unique_df: pd.DataFrame, id2axial: Dict[int, str]) -> pd.DataFrame:
-    out = retain_unique_df.copy()
-    out["axial_code"] = out["code_id"].apply(lambda cid: id2axial.get(int(cid), ""))
-    return out
+    return retain_unique_df.assign(axial_code=retain_unique_df["code_id"].map(id2axial).fillna(""))
 
 
 def make_axial_summary(retain_unique_with_axial: pd.DataFrame) -> pd.DataFrame:
-    df = retain_unique_with_axial.copy()
-    df["axial_code"] = df["axial_code"].astype(str).str.strip()
-    df = df[df["axial_code"] != ""].copy()
-
-    summary = (
-        df.groupby("axial_code")["open_code"]
-        .apply(lambda x: "; ".join(sorted(set(x))))
-        .reset_index()
-        .rename(columns={"open_code": "member_open_codes"})
-    )
-    summary["n_members"] = summary["member_open_codes"].apply(
-        lambda s: 0 if not isinstance(s, str) or not s.strip() else len(s.split("; "))
-    )
+    # 只取需要的两列组成新表，而非整表 copy 后再改列
+    axial = retain_unique_with_axial["axial_code"].astype(str).str.strip()
+    df = pd.DataFrame({"axial_code": axial, "open_code": retain_unique_with_axial["open_code"]})
+    df = df[axial != ""]
+
+    # 先去重 + 排序，再整体 agg(list)，避免逐组调用 Python lambda
+    df = df.drop_duplicates(["axial_code", "open_code"]).sort_values(["axial_code", "open_code"])
+    grouped = df.groupby("axial_code")["open_code"].agg(list)
+
+    summary = grouped.str.join("; ").rename("member_open_codes").reset_index()
+    summary["n_members"] = grouped.str.len().to_numpy()
     return summary
 
 
 def attach_axial_to_row_level(row_df: pd.DataFrame, retain_unique_with_axial: pd.DataFrame) -> pd.DataFrame:
     # code_id -> axial_code
-    mapping = {int(r["code_id"]): str(r["axial_code"]).strip() for _, r in retain_unique_with_axial.iterrows()}
-
-    out = row_df.copy()
-
-    def map_axial(x):
-        try:
-            cid = int(x)
-        except Exception:
-            return ""
-        return mapping.get(cid, "")
+    mapping = {
+        int(c): str(a).strip()
+        for c, a in zip(
+            retain_unique_with_axial["code_id"].to_numpy(), retain_unique_with_axial["axial_code"].to_numpy()
+        )
+    }
 
-    out["axial_code"] = out["code_id"].apply(map_axial)
-    return out
+    # Module2 产出的 code_id 已是整数列（Int32），直接按 dict map；其他来源（如从 xlsx 读回）再做数值转换
+    cid = row_df["code_id"]
+    if not pd.api.types.is_integer_dtype(cid):
+        cid = pd.to_numeric(cid, errors="coerce")
+    return row_df.assign(axial_code=cid.map(mapping).fillna("").astype(str))
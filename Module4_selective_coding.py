@@ -1,42 +1,32 @@
-import re
 import json
-from typing import Dict, Any, List, Tuple, Optional
+import threading
+from collections import Counter
+from typing import Dict, Any, Iterable, List, Optional, Tuple
 
 import pandas as pd
 import requests
 
-
-def safe_parse_json(text: str) -> Optional[dict]:
-    if not isinstance(text, str):
-        return None
-    s = text.strip()
-    s = re.sub(r"^```json\s*", "", s, flags=re.IGNORECASE)
-    s = re.sub(r"^```\s*", "", s)
-    s = re.sub(r"\s*```$", "", s)
-
-    try:
-        return json.loads(s)
-    except Exception:
-        pass
-
-    if "{" in s and "}" in s:
-        snippet = s[s.find("{"): s.rfind("}") + 1]
-        try:
-            return json.loads(snippet)
-        except Exception:
-            return None
-    return None
+import llm_cache
+from utils import SESSION, safe_parse_json, dumps_json_bytes, post_chat_content
 
 
 def build_selective_payload(axial_summary_df: pd.DataFrame, example_char_limit: int = 220) -> str:
-    items = []
-    for _, row in axial_summary_df.iterrows():
-        axial_code = str(row.get("axial_code", "")).strip()
-        if not axial_code:
-            continue
-        ex = str(row.get("member_open_codes", "") or "").strip().replace("\n", " ")
-        ex = ex[:example_char_limit] if example_char_limit > 0 else ""
-        items.append({"axial_code": axial_code, "member_open_codes_excerpt": ex})
+    # 整列 .str 处理后再 zip，避免 iterrows 逐行构造 Series
+    axial_codes = axial_summary_df["axial_code"].astype(str).str.strip()
+    excerpts = (
+        axial_summary_df["member_open_codes"]
+        .fillna("")
+        .astype(str)
+        .str.strip()
+        .str.replace("\n", " ", regex=False)
+        .str[: max(example_char_limit, 0)]
+    )
+
+    items = [
+        {"axial_code": axial_code, "member_open_codes_excerpt": ex}
+        for axial_code, ex in zip(axial_codes, excerpts)
+        if axial_code
+    ]
 
     return json.dumps({"axial_items": items}, ensure_ascii=False, separators=(",", ":"))
 
@@ -49,8 +39,10 @@ def deepseek_selective_coding(
     model: str,
     system_prompt: str,
     timeout: int = 300,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
 ) -> Dict[str, Any]:
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+    headers = {"Authorization": f"Bearer {api_key}"}
     payload_json = build_selective_payload(axial_summary_df, example_char_limit=220)
 
     user_content = (
@@ -68,28 +60,30 @@ def deepseek_selective_coding(
         "temperature": 0,
         "stream": False,
     }
+    body = dumps_json_bytes(payload)
 
-    resp = requests.post(base_url, headers=headers, json=payload, timeout=timeout)
-    resp.raise_for_status()
-    raw = resp.json()["choices"][0]["message"]["content"]
+    raw = post_chat_content(
+        session=session, base_url=base_url, headers=headers, body=body, timeout=timeout, limiter=limiter
+    )
 
     result = safe_parse_json(raw) or {}
+    if not isinstance(result.get("aggregate_concepts"), list):
+        llm_cache.invalidate(body)  # 结构不对的回复不留在缓存里，否则重跑会一直拿到同一份坏结果
     result["_raw_text"] = raw  # 方便 run.py 落盘 raw
     return result
 
 
-def validate_coverage(result: Dict[str, Any], axial_codes: List[str]) -> Tuple[List[str], List[str], List[str]]:
-    axial_set = set(axial_codes)
-    seen = []
+def validate_coverage(result: Dict[str, Any], axial_codes: Iterable[str]) -> Tuple[List[str], List[str], List[str]]:
+    # axial_codes 可直接传 frozenset（已是 set 时不再复制）；单趟 Counter 计数，其余均为集合差运算
+    axial_set = axial_codes if isinstance(axial_codes, (set, frozenset)) else frozenset(axial_codes)
+    cnt: Counter = Counter()
     for c in result.get("aggregate_concepts", []) or []:
         for a in c.get("covered_axial_codes", []) or []:
-            seen.append(str(a).strip())
-
-    seen_set = set(seen)
-    missing = [a for a in axial_codes if a not in seen_set]
-    extra = [a for a in seen_set if a not in axial_set]
-
-    from collections import Counter
-    cnt = Counter(seen)
-    dup = [k for k, v in cnt.items() if v > 1 and k]
-    return missing, extra, dup
\ No newline at end of file
+            a = str(a).strip()
+            if a:
+                cnt[a] += 1
+
+    missing = sorted(axial_set.difference(cnt))
+    extra = sorted(cnt.keys() - axial_set)
+    dup = sorted(k for k, v in cnt.items() if v > 1)
+    return missing, extra, dup
@@ -1,32 +1,16 @@
-import re
 import json
-from typing import Dict, Any, List, Optional, Tuple
+import threading
+from typing import Callable, Dict, Any, List, Optional, Tuple
 
 import pandas as pd
 import requests
 
+import llm_cache
+from utils import SESSION, safe_parse_json, dumps_json_bytes, post_chat_content
 
-def safe_parse_json(text: str) -> Optional[dict]:
-    if not isinstance(text, str):
-        return None
-    s = text.strip()
-    s = re.sub(r"^```json\s*", "", s, flags=re.IGNORECASE)
-    s = re.sub(r"^```\s*", "", s)
-    s = re.sub(r"\s*```$", "", s)
 
-    try:
-        return json.loads(s)
-    except Exception:
-        pass
-
-    if "{" in s and "}" in s:
-        start = s.find("{")
-        end = s.rfind("}") + 1
-        try:
-            return json.loads(s[start:end])
-        except Exception:
-            return None
-    return None
+# 多分隔符统一映射为 \x00 后一次 split，代替正则切分
+_SPLIT_TRANS = str.maketrans({";": "\x00", "；": "\x00", "、": "\x00", "|": "\x00", ",": "\x00"})
 
 
 def deepseek_chat(
@@ -37,8 +21,12 @@ def deepseek_chat(
     api_key: str,
     model: str,
     timeout: int = 420,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
+    accept: Optional[Callable[[Dict[str, Any]], bool]] = None,
 ) -> str:
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+    # accept：对解析后的 JSON 做结构校验，不通过时把该回复从磁盘缓存中剔除，重跑时会重新请求
+    headers = {"Authorization": f"Bearer {api_key}"}
     payload = {
         "model": model,
         "messages": [
@@ -48,9 +36,13 @@ def deepseek_chat(
         "temperature": 0,
         "stream": False,
     }
-    resp = requests.post(base_url, headers=headers, json=payload, timeout=timeout)
-    resp.raise_for_status()
-    return resp.json()["choices"][0]["message"]["content"]
+    body = dumps_json_bytes(payload)
+    raw = post_chat_content(
+        session=session, base_url=base_url, headers=headers, body=body, timeout=timeout, limiter=limiter
+    )
+    if accept is not None and not accept(safe_parse_json(raw) or {}):
+        llm_cache.invalidate(body)
+    return raw
 
 
 def pick_examples_from_member_text(
@@ -67,18 +59,22 @@ def pick_examples_from_member_text(
     s = member_text.replace("\n", " ").strip()
     if not s:
         return []
-    parts = re.split(r"[;；、]\s*|\|\s*|,\s*", s)
-    parts = [p.strip() for p in parts if p and p.strip()]
+    parts = [p.strip() for p in s.translate(_SPLIT_TRANS).split("\x00") if p.strip()]
 
+    # 有序去重：list 保序，set 做 O(1) 成员判断
+    seen_set = set()
     seen: List[str] = []
     for p in parts:
-        if p not in seen:
+        if p not in seen_set:
+            seen_set.add(p)
             seen.append(p)
 
+    out_set = set()
     out: List[str] = []
     for p in seen[: max_items * 3]:
         p2 = p[:max_chars_each]
-        if p2 and p2 not in out:
+        if p2 and p2 not in out_set:
+            out_set.add(p2)
             out.append(p2)
         if len(out) >= max_items:
             break
@@ -129,9 +125,9 @@ def build_one_shot_payload(
 
     # 2) axial themes + open examples（压缩）
     axial_items = []
-    for _, row in axial_df.iterrows():
-        ax = str(row.get("axial_code", "")).strip()
-        mem = str(row.get("member_open_codes", "") or "")
+    for ax, mem in zip(axial_df["axial_code"].to_numpy(), axial_df["member_open_codes"].to_numpy()):
+        ax = str(ax).strip()
+        mem = str(mem or "")
         examples = pick_examples_from_member_text(mem, max_items=max_open_examples_per_axial, max_chars_each=28)
         axial_items.append({"axial_code": ax, "open_code_examples": examples})
 
@@ -149,6 +145,8 @@ def generate_storyline(
     system_prompt_storyline: str,
     max_open_examples_per_axial: int = 6,
     timeout: int = 420,
+    session: requests.Session = SESSION,
+    limiter: Optional[threading.Semaphore] = None,
 ) -> Tuple[Dict[str, Any], str]:
     """
     返回：
@@ -177,12 +175,23 @@ def generate_storyline(
         api_key=api_key,
         model=model,
         timeout=timeout,
+        session=session,
+        limiter=limiter,
+        accept=is_valid_storyline_result,
     )
 
     result = safe_parse_json(raw) or {}
     return result, raw
 
 
+def is_valid_storyline_result(result: Dict[str, Any]) -> bool:
+    # 与 validate_storyline_result 同一标准：storyline 非空且 anchors 为非空列表
+    if not isinstance(result, dict):
+        return False
+    anchors = result.get("anchors")
+    return bool(str(result.get("storyline", "")).strip()) and isinstance(anchors, list) and len(anchors) > 0
+
+
 def validate_storyline_result(result: Dict[str, Any]) -> None:
     if "storyline" not in result or not str(result.get("storyline", "")).strip():
         raise RuntimeError("返回缺少 storyline 或 storyline 为空")
@@ -0,0 +1,72 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Any, Dict, Iterable, Tuple
+
+
+class ResumableBatch:
+    """
+    按请求哈希记录已完成结果的 progress.jsonl（追加写 + fsync）。
+    中断后重跑时先载入已完成的哈希，调用方据此把它们从待发送列表中剔除。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._done: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        self._done[rec["request_hash"]] = rec["result"]
+                    except Exception:
+                        continue  # 中断时可能留下半行，跳过即可
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._fh = open(path, "a", encoding="utf-8")
+        if self._fh.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._fh.write("\n")  # 先结束上次中断留下的半行，避免新记录被拼到它后面
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return hashlib.blake2b(raw, digest_size=20).hexdigest()
+
+    def __contains__(self, request_hash: str) -> bool:
+        return request_hash in self._done
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def get(self, request_hash: str, default: Any = None) -> Any:
+        return self._done.get(request_hash, default)
+
+    def record_many(self, items: Iterable[Tuple[str, Any]]) -> None:
+        lines = []
+        with self._lock:
+            for request_hash, result in items:
+                self._done[request_hash] = result
+                lines.append(json.dumps({"request_hash": request_hash, "result": result}, ensure_ascii=False))
+            if not lines:
+                return
+            self._fh.write("\n".join(lines) + "\n")
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def record(self, request_hash: str, result: Any) -> None:
+        self.record_many([(request_hash, result)])
+
+    def close(self) -> None:
+        self._fh.close()
+
+    def __enter__(self) -> "ResumableBatch":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
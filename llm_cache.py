@@ -0,0 +1,84 @@
+import os
+import gzip
+import json
+import hashlib
+import threading
+import functools
+from typing import Callable, Optional
+
+
+# 磁盘缓存目录；为 None 时缓存关闭（默认关闭，由 run.py 调用 enable 打开）
+_CACHE_DIR: Optional[str] = None
+
+
+def enable(cache_dir: str) -> None:
+    global _CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    _CACHE_DIR = cache_dir
+
+
+def disable() -> None:
+    global _CACHE_DIR
+    _CACHE_DIR = None
+
+
+def request_key(body: bytes) -> str:
+    # body 已包含 model + system_prompt + user 内容 + 采样参数，直接对其取哈希即可
+    return hashlib.blake2b(body, digest_size=20).hexdigest()
+
+
+def _path(key: str) -> str:
+    return os.path.join(_CACHE_DIR, key[:2], key + ".json.gz")
+
+
+def get(body: bytes) -> Optional[str]:
+    if _CACHE_DIR is None:
+        return None
+    try:
+        with gzip.open(_path(request_key(body)), "rt", encoding="utf-8") as f:
+            return json.load(f)["content"]
+    except Exception:
+        return None
+
+
+def put(body: bytes, content: str) -> None:
+    if _CACHE_DIR is None:
+        return
+    path = _path(request_key(body))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump({"content": content}, f, ensure_ascii=False)
+    os.replace(tmp, path)  # 原子替换，并发写同一 key 也不会读到半截文件
+
+
+def invalidate(body: bytes) -> None:
+    # 调用方发现缓存的回复无法解析时调用，避免重试时反复命中同一条坏结果
+    if _CACHE_DIR is None:
+        return
+    try:
+        os.remove(_path(request_key(body)))
+    except FileNotFoundError:
+        pass
+
+
+def cached(accept: Optional[Callable[[str], bool]] = None) -> Callable:
+    """
+    装饰形如 fn(*, body: bytes, ...) -> str 的调用点：命中则直接返回缓存的回复文本，
+    未命中则真正发请求，并在 accept(content) 为真时落盘。异常照常抛出，不写缓存。
+    """
+
+    def decorator(fn: Callable[..., str]) -> Callable[..., str]:
+        @functools.wraps(fn)
+        def wrapper(*args, body: bytes, **kwargs) -> str:
+            hit = get(body)
+            if hit is not None:
+                return hit
+            content = fn(*args, body=body, **kwargs)
+            if accept is None or accept(content):
+                put(body, content)
+            return content
+
+        return wrapper
+
+    return decorator
@@ -54,6 +54,25 @@ answer：肯定会下降
 }
 """
 
+# 批量开放编码（一次请求编码多个 QA 片段）：编码原则与示例沿用 SYSTEM_PROMPT_OPEN，只替换任务说明与输出格式
+_OPEN_CODING_RULES = SYSTEM_PROMPT_OPEN[SYSTEM_PROMPT_OPEN.index("【编码原则】"):SYSTEM_PROMPT_OPEN.index("【输出格式】")]
+
+SYSTEM_PROMPT_OPEN_BATCH = """
+你是一位严格遵循扎根理论（Grounded Theory）的质性研究编码员
+
+你的任务是：对给定的一组访谈问答片段（qa_blocks，每个片段带有 id）逐个进行开放性编码。
+每个片段以其 question 为背景知识，只对该片段的 answer 部分编码；片段之间相互独立，不要合并或互相参考。
+
+""" + _OPEN_CODING_RULES + """【输出格式】
+只输出 JSON，不要任何多余文字；每个输入 id 必须恰好对应一条结果，id 与输入保持一致：
+{
+  "open_codes": [
+    {"id": 1, "open_code": "编码结果"},
+    {"id": 2, "open_code": "编码结果"}
+  ]
+}
+"""
+
 SYSTEM_PROMPT_FILTER = """
 你是一位严格遵循扎根理论（Grounded Theory）的质性研究编码员。
 
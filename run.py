@@ -1,11 +1,15 @@
 # run.py
 import os
-import json
-from dotenv import load_dotenv
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
 import pandas as pd
 
 from prompts import (
     SYSTEM_PROMPT_OPEN,
+    SYSTEM_PROMPT_OPEN_BATCH,
     SYSTEM_PROMPT_FILTER,
     SYSTEM_PROMPT_AXIAL,
     SYSTEM_PROMPT_SELECTIVE,
@@ -13,8 +17,8 @@ from prompts import (
 )
 
 # === 按你的 Module 命名导入 ===
-from Module1_open_coding import run_open_coding_from_text
-from Module2_filtering import filter_unique_codes_with_batching, build_filter_outputs_from_open_df
+from Module1_open_coding import iter_open_coding_from_text
+from Module2_filtering import filter_codes_streaming, build_filter_outputs_from_open_df
 from Module3_axial_coding import (
     deepseek_axial_coding,
     attach_axial_to_retain_unique,
@@ -23,33 +27,92 @@ from Module3_axial_coding import (
 )
 from Module4_selective_coding import deepseek_selective_coding, validate_coverage
 from Module5_storyline import generate_storyline, validate_storyline_result
-
-
-def must_get_env(key: str) -> str:
-    v = os.getenv(key, "").strip()
-    if not v:
-        raise RuntimeError(f"Missing env var: {key}")
-    return v
+import llm_cache
+from checkpoint import ResumableBatch
+from settings import Settings
+from utils import EndpointPool, build_session, dump_json, save_df
 
 
 def ensure_dirs(*dirs: str):
+    # parents=True：只需传叶子目录，公共的 out_root 随第一个叶子一并创建
     for d in dirs:
-        os.makedirs(d, exist_ok=True)
+        Path(d).mkdir(parents=True, exist_ok=True)
+
+
+def write_text(text: str, path: str) -> None:
+    Path(path).write_bytes(text.encode("utf-8"))
+
+
+class OutputWriter:
+    """
+    长期存活的写盘线程池：各阶段把结果文件交给它后立刻进入下一阶段的 LLM 请求，
+    xlsx / json 序列化与网络等待重叠；wait() 在运行结束前统一等待并逐阶段报告。
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="output")
+        self._stages: List[Tuple[str, List[str], List[Future]]] = []
+
+    def submit(self, label: str, jobs: List[Tuple[Callable[[Any, str], None], Any, str]]) -> None:
+        # 提交后调用方不得再修改这些对象（写盘线程只读）
+        futures = [self._pool.submit(fn, obj, path) for fn, obj, path in jobs]
+        self._stages.append((label, [path for _, _, path in jobs], futures))
+
+    def wait(self) -> None:
+        # 逐阶段报告；某个文件写失败不影响其余阶段的报告，全部报告完后再抛出第一个写盘异常
+        first_err = None
+        try:
+            for label, paths, futures in self._stages:
+                errors = [e for e in (fut.exception() for fut in futures) if e is not None]
+                if errors:
+                    print(f"❌ {label} write failed: {errors[0]!r}")
+                    first_err = first_err or errors[0]
+                    continue
+                print(f"✅ {label} saved:")
+                for path in paths:
+                    print(" -", path)
+        finally:
+            self._pool.shutdown(wait=True)
+        if first_err is not None:
+            raise first_err
+
+
+def merge_model_caps(caps: List[Tuple[str, int]]) -> Dict[str, int]:
+    """同一模型被多个阶段使用时共用一个池，取其中最小的上限"""
+    merged: Dict[str, int] = {}
+    for model, cap in caps:
+        cap = max(1, cap)
+        merged[model] = min(cap, merged.get(model, cap))
+    return merged
 
 
 def main():
-    load_dotenv()
-
     # =====================================================
-    # 0) Env Config
+    # 0) Env Config（启动时一次性读取并校验）
     # =====================================================
-    api_key = must_get_env("DEEPSEEK_API_KEY")
-    base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/chat/completions").strip()
-
-    model_open = os.getenv("DEEPSEEK_OPEN_MODEL", "deepseek-chat").strip()
-    model_filter = os.getenv("DEEPSEEK_FILTER_MODEL", "deepseek-reasoner").strip()
-    model_axial = os.getenv("DEEPSEEK_AXIAL_MODEL", "deepseek-reasoner").strip()
-    model_reasoner = os.getenv("DEEPSEEK_REASONER_MODEL", "deepseek-reasoner").strip()
+    settings = Settings.from_env()
+    api_key = settings.api_key
+    base_url = settings.base_url
+
+    # 按模型分池限制在途请求数：chat 模型延迟短可高并发，reasoner 延迟长、限流更紧；
+    # 429/5xx 由 utils.call_with_backoff 指数退避重试
+    model_caps = merge_model_caps(
+        [
+            (settings.open_model, settings.max_async_open),
+            (settings.filter_model, settings.max_async_filter),
+            (settings.axial_model, settings.max_async_axial),
+            (settings.selective_model, settings.max_async_reasoner),
+            (settings.storyline_model, settings.max_async_reasoner),
+        ]
+    )
+    limiters = {model: threading.BoundedSemaphore(cap) for model, cap in model_caps.items()}
+    # 全流程共用一个长连接池，所有模块的请求都经由它发出；
+    # 池容量取各模型上限之和（各阶段流水线重叠时的最大在途数），避免多余连接被丢弃而失去 keep-alive
+    session = build_session(api_key, pool_maxsize=sum(model_caps.values()))
+    # 配置了 DEEPSEEK_ENDPOINTS 时，Module3 在多个端点间分流并自动故障转移
+    axial_endpoints = None
+    if settings.axial_endpoints:
+        axial_endpoints = EndpointPool(settings.axial_endpoints, default_api_key=api_key)
 
     # =====================================================
     # 1) Paths (Relative)
@@ -57,176 +120,200 @@ def main():
     input_txt = "data/interview_merged.txt"
 
     out_root = "outputs"
+    out_open_dir = os.path.join(out_root, "open_coding")
     out_filter_dir = os.path.join(out_root, "filtering")
     out_axial_dir = os.path.join(out_root, "axial")
     out_selective_dir = os.path.join(out_root, "selective")
     out_story_dir = os.path.join(out_root, "storyline")
 
-    ensure_dirs(out_root, out_filter_dir, out_axial_dir, out_selective_dir, out_story_dir)
-
-    # =====================================================
-    # Step 1) Open Coding
-    # =====================================================
-    with open(input_txt, "r", encoding="utf-8") as f:
-        text = f.read()
-
-    open_df = run_open_coding_from_text(
-        text=text,
-        base_url=base_url,
-        api_key=api_key,
-        model=model_open,
-        system_prompt=SYSTEM_PROMPT_OPEN,
-        sleep_time=1.0,
-    )
-
-    open_xlsx = os.path.join(out_root, "open_coding.xlsx")
-    open_df.to_excel(open_xlsx, index=False)
-    print("✅ [Module1] open coding saved:", open_xlsx)
-
-    # =====================================================
-    # Step 2) Filtering
-    # =====================================================
-    all_codes = [
-        str(c).strip()
-        for c in open_df["open_code"].tolist()
-        if isinstance(c, str) and str(c).strip()
-    ]
-    unique_codes = list(dict.fromkeys(all_codes))  # 保序去重
-    print(f"[Module2] open_code total={len(all_codes)}, unique={len(unique_codes)}")
-
-    id2retain, id2reason, id2code = filter_unique_codes_with_batching(
-        unique_codes=unique_codes,
-        base_url=base_url,
-        api_key=api_key,
-        model=model_filter,
-        system_prompt=SYSTEM_PROMPT_FILTER,
-        batch_size=60,
-    )
-
-    row_df, unique_df, retain_unique_df, exclude_unique_df = build_filter_outputs_from_open_df(
-        open_df=open_df,
-        id2retain=id2retain,
-        id2reason=id2reason,
-        id2code=id2code,
-    )
-
-    row_path = os.path.join(out_filter_dir, "open_code_filter_row_level.xlsx")
-    unique_all_path = os.path.join(out_filter_dir, "open_code_unique_with_filter.xlsx")
-    retain_path = os.path.join(out_filter_dir, "open_code_retain_unique.xlsx")
-    exclude_path = os.path.join(out_filter_dir, "open_code_exclude_unique.xlsx")
-
-    row_df.to_excel(row_path, index=False)
-    unique_df.to_excel(unique_all_path, index=False)
-    retain_unique_df.to_excel(retain_path, index=False)
-    exclude_unique_df.to_excel(exclude_path, index=False)
-
-    print("✅ [Module2] filtering saved:")
-    print(" -", row_path)
-    print(" -", unique_all_path)
-    print(" -", retain_path)
-    print(" -", exclude_path)
-
-    # =====================================================
-    # Step 3) Axial Coding
-    # =====================================================
-    retain_unique_df = retain_unique_df[retain_unique_df["retain"] == True].copy()
-    retain_unique_df["code_id"] = retain_unique_df["code_id"].astype(int)
-    retain_unique_df["open_code"] = retain_unique_df["open_code"].astype(str).str.strip()
-
-    id2axial = deepseek_axial_coding(
-        retain_unique_df=retain_unique_df[["code_id", "open_code"]],
-        base_url=base_url,
-        api_key=api_key,
-        model=model_axial,
-        system_prompt=SYSTEM_PROMPT_AXIAL,
-    )
-
-    retain_with_axial = attach_axial_to_retain_unique(retain_unique_df, id2axial)
-    axial_unique_path = os.path.join(out_axial_dir, "open_code_retain_unique_axial.xlsx")
-    retain_with_axial.to_excel(axial_unique_path, index=False)
-
-    axial_summary = make_axial_summary(retain_with_axial)
-    axial_summary_path = os.path.join(out_axial_dir, "axial_coding_summary.xlsx")
-    axial_summary.to_excel(axial_summary_path, index=False)
-
-    row_with_axial = attach_axial_to_row_level(row_df, retain_with_axial)
-    axial_row_path = os.path.join(out_axial_dir, "axial_coding_row_level.xlsx")
-    row_with_axial.to_excel(axial_row_path, index=False)
-
-    print("✅ [Module3] axial coding saved:")
-    print(" -", axial_unique_path)
-    print(" -", axial_summary_path)
-    print(" -", axial_row_path)
-
-    # =====================================================
-    # Step 4) Selective Coding
-    # =====================================================
-    selective_result = deepseek_selective_coding(
-        axial_summary_df=axial_summary,
-        base_url=base_url,
-        api_key=api_key,
-        model=model_reasoner,
-        system_prompt=SYSTEM_PROMPT_SELECTIVE,
-    )
-
-    selective_raw = selective_result.pop("_raw_text", "")
-    selective_raw_path = os.path.join(out_selective_dir, "selective_coding_raw.txt")
-    with open(selective_raw_path, "w", encoding="utf-8") as f:
-        f.write(selective_raw)
-
-    axial_codes = axial_summary["axial_code"].astype(str).str.strip().tolist()
-    miss, extra, dup = validate_coverage(selective_result, axial_codes)
-    if miss or extra or dup:
-        selective_result["_coverage_warning"] = {
-            "missing_axial_codes": miss,
-            "extra_axial_codes_in_output": extra,
-            "duplicated_axial_codes": dup,
-        }
-
-    selective_json_path = os.path.join(out_selective_dir, "selective_coding_agg_only.json")
-    with open(selective_json_path, "w", encoding="utf-8") as f:
-        json.dump(selective_result, f, ensure_ascii=False, indent=2)
-
-    selective_xlsx_path = os.path.join(out_selective_dir, "selective_coding_agg_only.xlsx")
-    pd.DataFrame(selective_result.get("aggregate_concepts", []) or []).to_excel(selective_xlsx_path, index=False)
-
-    print("✅ [Module4] selective coding saved:")
-    print(" -", selective_raw_path)
-    print(" -", selective_json_path)
-    print(" -", selective_xlsx_path)
-
-    # =====================================================
-    # Step 5) Storyline
-    # =====================================================
-    storyline_result, storyline_raw = generate_storyline(
-        selective_json=selective_result,
-        axial_summary_df=axial_summary,
-        base_url=base_url,
-        api_key=api_key,
-        model=model_reasoner,
-        system_prompt_storyline=SYSTEM_PROMPT_STORYLINE,
-        max_open_examples_per_axial=6,
-        timeout=420,
-    )
-
-    story_raw_path = os.path.join(out_story_dir, "storyline_raw.txt")
-    with open(story_raw_path, "w", encoding="utf-8") as f:
-        f.write(storyline_raw)
-
-    validate_storyline_result(storyline_result)
-
-    story_txt_path = os.path.join(out_story_dir, "storyline.txt")
-    with open(story_txt_path, "w", encoding="utf-8") as f:
-        f.write(str(storyline_result["storyline"]).strip())
-
-    story_json_path = os.path.join(out_story_dir, "storyline.json")
-    with open(story_json_path, "w", encoding="utf-8") as f:
-        json.dump(storyline_result, f, ensure_ascii=False, indent=2)
-
-    print("✅ [Module5] storyline saved:")
-    print(" -", story_raw_path)
-    print(" -", story_txt_path)
-    print(" -", story_json_path)
+    ensure_dirs(out_open_dir, out_filter_dir, out_axial_dir, out_selective_dir, out_story_dir)
+    # 结果文件在后台写出，不阻塞下一阶段的请求
+    writer = OutputWriter(max_workers=4)
+
+    # 任一阶段失败时也要等后台写盘结束：已完成阶段照常报告，写盘异常不会被吞掉
+    try:
+        # LLM 回复磁盘缓存：相同请求（model + prompt + payload）重跑时直接命中；LLM_CACHE=0 关闭
+        if settings.llm_cache:
+            llm_cache.enable(os.path.join(out_root, ".llm_cache"))
+
+        # =====================================================
+        # Step 1 + 2) Open Coding -> Filtering（流水线）
+        #   Module1 每完成一批 QA 就把 open_code 交给 Module2，
+        #   Module2 凑满一批新 code 即开始筛选，两阶段的请求同时在途
+        #   每批完成即追加写入 progress.jsonl，中断后重跑只请求剩余部分
+        # =====================================================
+        open_rows = []
+        open_progress = ResumableBatch(os.path.join(out_open_dir, "progress.jsonl"))
+        filter_progress = ResumableBatch(os.path.join(out_filter_dir, "progress.jsonl"))
+
+        def iter_open_codes(chunks):
+            for row in iter_open_coding_from_text(
+                text=chunks,
+                base_url=base_url,
+                api_key=api_key,
+                session=session,
+                limiter=limiters[settings.open_model],
+                model=settings.open_model,
+                system_prompt=SYSTEM_PROMPT_OPEN,
+                batch_system_prompt=SYSTEM_PROMPT_OPEN_BATCH,
+                batch_size=20,
+                concurrency=settings.max_async_open,
+                checkpoint=open_progress,
+            ):
+                open_rows.append(row)
+                code = row["open_code"]
+                if isinstance(code, str) and code.strip():
+                    yield code.strip()
+
+        # 输入按 64KB 分块读取并边读边切 QA，不把整份访谈文本一次性读进内存
+        with open(input_txt, "r", encoding="utf-8") as f, open_progress, filter_progress:
+            id2retain, id2reason, id2code = filter_codes_streaming(
+                codes=iter_open_codes(iter(lambda: f.read(65536), "")),
+                base_url=base_url,
+                api_key=api_key,
+                session=session,
+                limiter=limiters[settings.filter_model],
+                model=settings.filter_model,
+                system_prompt=SYSTEM_PROMPT_FILTER,
+                batch_size=settings.filter_max_batch_size,
+                max_wait_ms=settings.filter_max_wait_ms,
+                max_workers=settings.max_async_filter,
+                checkpoint=filter_progress,
+            )
+        open_df = pd.DataFrame(open_rows)
+
+        open_xlsx = os.path.join(out_root, "open_coding.xlsx")
+        writer.submit("[Module1] open coding", [(save_df, open_df, open_xlsx)])
+
+        # 去重已在 filter_codes_streaming 中边接收边完成，这里只做向量化计数（非字符串 strip 后为 NaN）
+        stripped = open_df["open_code"].astype(object).str.strip()
+        n_total = int(stripped.str.len().gt(0).sum())
+        print(f"[Module2] open_code total={n_total}, unique={len(id2code)}")
+
+        row_df, unique_df, retain_unique_df, exclude_unique_df = build_filter_outputs_from_open_df(
+            open_df=open_df,
+            id2retain=id2retain,
+            id2reason=id2reason,
+            id2code=id2code,
+            emit_excluded=settings.emit_audit_xlsx,
+        )
+
+        row_path = os.path.join(out_filter_dir, "open_code_filter_row_level.xlsx")
+        unique_all_path = os.path.join(out_filter_dir, "open_code_unique_with_filter.xlsx")
+        retain_path = os.path.join(out_filter_dir, "open_code_retain_unique.xlsx")
+        exclude_path = os.path.join(out_filter_dir, "open_code_exclude_unique.xlsx")
+
+        filter_jobs = [
+            (save_df, row_df, row_path),
+            (save_df, unique_df, unique_all_path),
+            (save_df, retain_unique_df, retain_path),
+        ]
+        if exclude_unique_df is not None:
+            filter_jobs.append((save_df, exclude_unique_df, exclude_path))
+        writer.submit("[Module2] filtering", filter_jobs)
+
+        # =====================================================
+        # Step 3) Axial Coding
+        # =====================================================
+        # retain_unique_df 已只含 retain=True 的行（Module2 中一次布尔掩码切出），code_id / open_code 的类型也已确定；
+        # deepseek_axial_coding 只按列名读取这两列，直接传入即可，不必先切列复制
+        id2axial = deepseek_axial_coding(
+            retain_unique_df=retain_unique_df,
+            base_url=base_url,
+            api_key=api_key,
+            session=session,
+            limiter=limiters[settings.axial_model],
+            endpoints=axial_endpoints,
+            model=settings.axial_model,
+            system_prompt=SYSTEM_PROMPT_AXIAL,
+        )
+
+        retain_with_axial = attach_axial_to_retain_unique(retain_unique_df, id2axial)
+        axial_summary = make_axial_summary(retain_with_axial)
+        row_with_axial = attach_axial_to_row_level(row_df, retain_with_axial)
+
+        axial_unique_path = os.path.join(out_axial_dir, "open_code_retain_unique_axial.xlsx")
+        axial_summary_path = os.path.join(out_axial_dir, "axial_coding_summary.xlsx")
+        axial_row_path = os.path.join(out_axial_dir, "axial_coding_row_level.xlsx")
+
+        writer.submit(
+            "[Module3] axial coding",
+            [
+                (save_df, retain_with_axial, axial_unique_path),
+                (save_df, axial_summary, axial_summary_path),
+                (save_df, row_with_axial, axial_row_path),
+            ],
+        )
+
+        # =====================================================
+        # Step 4) Selective Coding
+        # =====================================================
+        selective_result = deepseek_selective_coding(
+            axial_summary_df=axial_summary,
+            base_url=base_url,
+            api_key=api_key,
+            session=session,
+            limiter=limiters[settings.selective_model],
+            model=settings.selective_model,
+            system_prompt=SYSTEM_PROMPT_SELECTIVE,
+        )
+
+        selective_raw = selective_result.pop("_raw_text", "")
+        selective_raw_path = os.path.join(out_selective_dir, "selective_coding_raw.txt")
+
+        axial_codes = frozenset(axial_summary["axial_code"])  # make_axial_summary 产出的已是 strip 后的 str
+        miss, extra, dup = validate_coverage(selective_result, axial_codes)
+        if miss or extra or dup:
+            selective_result["_coverage_warning"] = {
+                "missing_axial_codes": miss,
+                "extra_axial_codes_in_output": extra,
+                "duplicated_axial_codes": dup,
+            }
+
+        selective_json_path = os.path.join(out_selective_dir, "selective_coding_agg_only.json")
+        selective_xlsx_path = os.path.join(out_selective_dir, "selective_coding_agg_only.xlsx")
+        writer.submit(
+            "[Module4] selective coding",
+            [
+                (write_text, selective_raw, selective_raw_path),
+                (dump_json, selective_result, selective_json_path),
+                (save_df, pd.DataFrame(selective_result.get("aggregate_concepts", []) or []), selective_xlsx_path),
+            ],
+        )
+
+        # =====================================================
+        # Step 5) Storyline
+        # =====================================================
+        storyline_result, storyline_raw = generate_storyline(
+            selective_json=selective_result,
+            axial_summary_df=axial_summary,
+            base_url=base_url,
+            api_key=api_key,
+            session=session,
+            limiter=limiters[settings.storyline_model],
+            model=settings.storyline_model,
+            system_prompt_storyline=SYSTEM_PROMPT_STORYLINE,
+            max_open_examples_per_axial=6,
+            timeout=420,
+        )
+
+        story_raw_path = os.path.join(out_story_dir, "storyline_raw.txt")
+        # raw 先落盘（校验失败时也保留模型原始输出），校验通过后再写正式结果
+        writer.submit("[Module5] storyline raw", [(write_text, storyline_raw, story_raw_path)])
+
+        validate_storyline_result(storyline_result)
+
+        story_txt_path = os.path.join(out_story_dir, "storyline.txt")
+        story_json_path = os.path.join(out_story_dir, "storyline.json")
+        writer.submit(
+            "[Module5] storyline",
+            [
+                (write_text, str(storyline_result["storyline"]).strip(), story_txt_path),
+                (dump_json, storyline_result, story_json_path),
+            ],
+        )
+    finally:
+        writer.wait()
 
     print("\n🎯 All modules finished successfully.\n")
 
@@ -0,0 +1,123 @@
+import os
+import json
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Tuple, TypeVar
+
+from dotenv import load_dotenv
+
+T = TypeVar("T")
+
+_MAX_WAIT_MS_LIMIT = 600_000.0  # MAX_WAIT_MS 上限（10 分钟）：过大的值会让 queue.get(timeout=...) 溢出
+
+
+def _env_str(key: str, default: str) -> str:
+    return os.getenv(key, default).strip() or default
+
+
+def _env_num(
+    key: str, default: T, cast: Callable[[str], T], min_value: Optional[T] = None, max_value: Optional[T] = None
+) -> T:
+    raw = os.getenv(key, "").strip()
+    if not raw:
+        return default
+    try:
+        value = cast(raw)
+    except ValueError:
+        raise RuntimeError(f"Invalid env var: {key}={raw!r}") from None
+    # 用 not (...) 的写法让 nan 也判为越界；设了 max_value 时 inf 同样被拒绝
+    if min_value is not None and not value >= min_value:
+        raise RuntimeError(f"Invalid env var: {key}={raw!r} (must be >= {min_value})")
+    if max_value is not None and not value <= max_value:
+        raise RuntimeError(f"Invalid env var: {key}={raw!r} (must be <= {max_value})")
+    return value
+
+
+def _env_endpoints(key: str, default_capacity: int) -> Tuple[Tuple[str, Optional[str], int], ...]:
+    # JSON 列表：元素为 URL 字符串，或 {"base_url": ..., "api_key": ...（可选）, "concurrency": ...（可选）}
+    raw = os.getenv(key, "").strip()
+    if not raw:
+        return ()
+    try:
+        items = json.loads(raw)
+        if not isinstance(items, list):
+            raise ValueError
+        specs = []
+        for item in items:
+            if isinstance(item, str):
+                item = {"base_url": item}
+            base_url = str(item["base_url"]).strip()
+            if not base_url:
+                raise ValueError
+            api_key = str(item.get("api_key") or "").strip() or None
+            capacity = int(item.get("concurrency", default_capacity))
+            if capacity < 1:
+                raise ValueError
+            specs.append((base_url, api_key, capacity))
+    except (ValueError, TypeError, KeyError):
+        raise RuntimeError(f"Invalid env var: {key} (expect a JSON list of endpoints, concurrency >= 1)") from None
+    return tuple(specs)
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    全部运行配置：启动时从 .env / 环境变量一次性读取并校验，
+    缺少必填项或数值非法时在发出任何 LLM 请求之前就报错。
+    """
+
+    api_key: str = field(repr=False)  # 避免打印 settings 时泄露密钥
+    base_url: str = "https://api.deepseek.com/chat/completions"
+
+    open_model: str = "deepseek-chat"
+    filter_model: str = "deepseek-reasoner"
+    axial_model: str = "deepseek-reasoner"
+    selective_model: str = "deepseek-reasoner"
+    storyline_model: str = "deepseek-reasoner"
+
+    # Module2 动态组批
+    filter_max_batch_size: int = 60
+    filter_max_wait_ms: float = 2000.0
+
+    # 各阶段的并发线程数，同时也是所用模型的在途请求上限（同一模型被多个阶段使用时取最小值）
+    max_async_open: int = 64
+    max_async_filter: int = 8
+    max_async_axial: int = 8
+    max_async_reasoner: int = 4
+
+    # Module3 可用的多个 DeepSeek 兼容端点 (base_url, api_key 或 None, 并发上限)；为空时只用 base_url
+    axial_endpoints: Tuple[Tuple[str, Optional[str], int], ...] = field(default=(), repr=False)
+
+    llm_cache: bool = True
+    emit_audit_xlsx: bool = False  # 是否额外写出仅供审计的 open_code_exclude_unique.xlsx
+
+    @classmethod
+    def from_env(cls, env_file: Optional[str] = ".env") -> "Settings":
+        if env_file:
+            load_dotenv(env_file)
+
+        api_key = os.getenv("DEEPSEEK_API_KEY", "").strip()
+        if not api_key:
+            raise RuntimeError("Missing env var: DEEPSEEK_API_KEY")
+
+        # 选择性编码 / Storyline 未单独指定模型时沿用 DEEPSEEK_REASONER_MODEL
+        reasoner = _env_str("DEEPSEEK_REASONER_MODEL", cls.selective_model)
+        return cls(
+            api_key=api_key,
+            base_url=_env_str("DEEPSEEK_BASE_URL", cls.base_url),
+            open_model=_env_str("DEEPSEEK_OPEN_MODEL", cls.open_model),
+            filter_model=_env_str("DEEPSEEK_FILTER_MODEL", cls.filter_model),
+            axial_model=_env_str("DEEPSEEK_AXIAL_MODEL", cls.axial_model),
+            selective_model=_env_str("DEEPSEEK_SELECTIVE_MODEL", reasoner),
+            storyline_model=_env_str("DEEPSEEK_STORYLINE_MODEL", reasoner),
+            filter_max_batch_size=_env_num("MAX_BATCH_SIZE", cls.filter_max_batch_size, int, 1),
+            filter_max_wait_ms=_env_num("MAX_WAIT_MS", cls.filter_max_wait_ms, float, 0.0, _MAX_WAIT_MS_LIMIT),
+            max_async_open=_env_num("LLM_MAX_ASYNC_OPEN", cls.max_async_open, int, 1),
+            max_async_filter=_env_num("LLM_MAX_ASYNC_FILTER", cls.max_async_filter, int, 1),
+            max_async_axial=_env_num("LLM_MAX_ASYNC_AXIAL", cls.max_async_axial, int, 1),
+            max_async_reasoner=_env_num("LLM_MAX_ASYNC_REASONER", cls.max_async_reasoner, int, 1),
+            axial_endpoints=_env_endpoints(
+                "DEEPSEEK_ENDPOINTS", _env_num("LLM_MAX_ASYNC_AXIAL", cls.max_async_axial, int, 1)
+            ),
+            llm_cache=os.getenv("LLM_CACHE", "1").strip() != "0",
+            emit_audit_xlsx=os.getenv("EMIT_AUDIT_XLSX", "0").strip() == "1",
+        )
@@ -0,0 +1,224 @@
+import json
+import time
+import random
+import threading
+import importlib.util
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+import llm_cache
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，缺失时回退到标准库 json
+    orjson = None
+
+# xlsxwriter 为可选依赖：只写不读的场景比 openpyxl 快得多，缺失时回退到 pandas 默认引擎
+_HAS_XLSXWRITER = importlib.util.find_spec("xlsxwriter") is not None
+
+
+def build_session(api_key: Optional[str] = None, pool_maxsize: int = 64) -> requests.Session:
+    # 连接池化的 Session（HTTP keep-alive，省去重复的 TCP/TLS 握手）；默认请求头在构造时一次设好
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize, max_retries=0))
+    session.headers.update({"Content-Type": "application/json"})
+    if api_key:
+        session.headers.update({"Authorization": f"Bearer {api_key}"})
+    return session
+
+
+# 各模块函数未显式传入 session 时的共用默认值
+SESSION = build_session()
+
+
+def dumps_json_bytes(obj: Any) -> bytes:
+    # 请求体只序列化一次，重试时直接复用同一份 bytes
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dump_json(obj: Any, path: str) -> None:
+    # 结果文件：orjson 直接产出 UTF-8 bytes（不转义中文），缺失时回退到 json.dumps(ensure_ascii=False)
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        data = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def loads_json(data: Any) -> Any:
+    # orjson 直接解析 bytes（resp.content），省去先解码成 str 的一步
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def save_df(df: pd.DataFrame, path: str) -> None:
+    # 不开 constant_memory：pandas 按列写单元格，而该模式要求逐行顺序写入，否则会丢数据
+    if _HAS_XLSXWRITER:
+        options = {"strings_to_urls": False}  # open_code 原样保留，不自动转超链接
+        with pd.ExcelWriter(path, engine="xlsxwriter", engine_kwargs={"options": options}) as writer:
+            df.to_excel(writer, index=False)
+    else:
+        df.to_excel(path, index=False)
+
+
+def safe_parse_json(text: str) -> Optional[dict]:
+    if not isinstance(text, str):
+        return None
+    s = text.strip()
+    # 剥离 ```json ... ``` 包裹：纯字符串操作即可，无需正则
+    if s[:7].lower() == "```json":
+        s = s[7:].lstrip()
+    elif s.startswith("```"):
+        s = s[3:].lstrip()
+    if s.endswith("```"):
+        s = s[:-3].rstrip()
+
+    try:
+        return loads_json(s)
+    except Exception:
+        pass
+
+    if "{" in s and "}" in s:
+        snippet = s[s.find("{"): s.rfind("}") + 1]
+        try:
+            return loads_json(snippet)
+        except Exception:
+            return None
+    return None
+
+
+T = TypeVar("T")
+
+# 限流 / 服务端过载：等一会儿再发同一请求通常就能成功
+_BACKOFF_STATUS = frozenset({429, 500, 502, 503})
+
+
+def call_with_backoff(
+    send: Callable[[], T],
+    *,
+    limiter: Optional[threading.Semaphore] = None,
+    max_attempts: int = 6,
+    base_delay: float = 1.0,
+    max_delay: float = 30.0,
+) -> T:
+    """
+    send() 发出请求并读完响应（失败时 raise_for_status）。持有 limiter 期间才算一个在途请求；
+    遇 429/5xx 按指数退避 + 随机抖动重试，退避等待时不占用并发名额。
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            with limiter if limiter is not None else nullcontext():
+                return send()
+        except requests.HTTPError as e:
+            status = getattr(e.response, "status_code", None)
+            if status not in _BACKOFF_STATUS or attempt == max_attempts:
+                raise
+        delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+        time.sleep(delay + random.uniform(0, base_delay))
+    raise AssertionError("unreachable")
+
+
+@llm_cache.cached(accept=lambda content: safe_parse_json(content) is not None)
+def post_chat_content(
+    *,
+    session: requests.Session,
+    base_url: str,
+    headers: Dict[str, str],
+    body: bytes,
+    timeout: int,
+    limiter: Optional[threading.Semaphore] = None,
+    backoff_attempts: int = 6,
+) -> str:
+    # 非流式 chat/completions 调用，返回 choices[0].message.content；可解析为 JSON 的回复会写入磁盘缓存
+    def send() -> str:
+        resp = session.post(base_url, headers=headers, data=body, timeout=timeout)
+        resp.raise_for_status()
+        return loads_json(resp.content)["choices"][0]["message"]["content"]
+
+    return call_with_backoff(send, limiter=limiter, max_attempts=backoff_attempts)
+
+
+def is_non_retriable_http_error(err: Exception) -> bool:
+    # 4xx（除 408 超时 / 429 限流）属于请求本身的问题，重试同一请求没有意义
+    status = getattr(getattr(err, "response", None), "status_code", None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+
+def _is_failover_error(err: Exception) -> bool:
+    # 超时 / 连接失败 / 限流 / 5xx：换一个端点通常就能成功
+    if isinstance(err, (requests.Timeout, requests.ConnectionError)):
+        return True
+    status = getattr(getattr(err, "response", None), "status_code", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+@dataclass
+class _Endpoint:
+    base_url: str
+    session: requests.Session
+    limiter: threading.BoundedSemaphore
+    capacity: int
+    has_own_key: bool
+    in_flight: int = 0
+
+
+class EndpointPool:
+    """
+    多个 DeepSeek 兼容端点（镜像部署等），各自独立的 Session 与并发上限。
+    请求优先发往空闲名额最多的端点；遇超时 / 连接失败 / 429 / 5xx 立即改投下一个端点，
+    只有最后一个候选端点才按常规指数退避重试。
+    """
+
+    def __init__(self, specs: Iterable[Tuple[str, Optional[str], int]], default_api_key: str):
+        self._lock = threading.Lock()
+        self._endpoints: List[_Endpoint] = []
+        for base_url, api_key, capacity in specs:
+            capacity = max(1, capacity)
+            self._endpoints.append(
+                _Endpoint(
+                    base_url=base_url,
+                    session=build_session(api_key or default_api_key, pool_maxsize=capacity),
+                    limiter=threading.BoundedSemaphore(capacity),
+                    capacity=capacity,
+                    has_own_key=bool(api_key),
+                )
+            )
+        if not self._endpoints:
+            raise ValueError("EndpointPool 至少需要一个端点")
+
+    def post_chat_content(self, *, headers: Dict[str, str], body: bytes, timeout: int) -> str:
+        with self._lock:
+            order = sorted(self._endpoints, key=lambda ep: ep.capacity - ep.in_flight, reverse=True)
+
+        for i, ep in enumerate(order):
+            is_last = i == len(order) - 1
+            # 端点自带 api_key 时以其 Session 上的 Authorization 为准，不被调用方的默认密钥覆盖
+            req_headers = {k: v for k, v in headers.items() if k != "Authorization"} if ep.has_own_key else headers
+            with self._lock:
+                ep.in_flight += 1
+            try:
+                return post_chat_content(
+                    session=ep.session,
+                    base_url=ep.base_url,
+                    headers=req_headers,
+                    body=body,
+                    timeout=timeout,
+                    limiter=ep.limiter,
+                    backoff_attempts=6 if is_last else 1,
+                )
+            except requests.RequestException as e:
+                if is_last or not _is_failover_error(e):
+                    raise
+            finally:
+                with self._lock:
+                    ep.in_flight -= 1
+        raise AssertionError("unreachable")